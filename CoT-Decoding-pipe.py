@@ -5,15 +5,86 @@ date: 2024-10-15
 version: 1.6
 license: MIT
 description: A pipeline that implements Chain-of-Thought decoding using the Ollama API, with self-evaluation and conversation history tracking using messages.
-requirements: requests
+requirements: requests, httpx[http2], orjson, numpy
 """
 
 from typing import List, Union, Generator, Iterator, Optional
+import asyncio
+import gzip
+import hashlib
+import importlib.util
 import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from difflib import SequenceMatcher
 import requests
-import random
+import httpx
+import numpy as np
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pydantic import BaseModel
 
+JSON_HEADERS = {"Content-Type": "application/json"}
+GZIP_JSON_HEADERS = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+# Smaller bodies are not worth the compression overhead
+GZIP_MIN_SIZE = 4096
+# httpx needs the h2 package for HTTP/2 support
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _encode_chat_request(model: str, messages_json: bytes, **fields) -> bytes:
+    # Splice already serialized messages into the request body, so a long
+    # history shared by several requests is only encoded once
+    body = b'{"model":' + orjson.dumps(model) + b',"messages":' + messages_json
+    if fields:
+        body += b',' + orjson.dumps(fields)[1:]
+    else:
+        body += b'}'
+    return body
+
+
+_NUMBER_RE = re.compile(r"-?\d+(?:[.,]\d+)*")
+
+
+def _answer_signature(content: str) -> tuple:
+    # What a CoT path concludes: its normalized last line and the numbers it
+    # uses. Paths that share the reasoning but differ here reach different
+    # answers and must both reach the evaluation step.
+    lines = [line for line in content.splitlines() if line.strip()]
+    last_line = " ".join(lines[-1].lower().split()) if lines else ""
+    return last_line, tuple(_NUMBER_RE.findall(content))
+
+
+def _make_candidates(contents: List[str], confidences: List[float], infos: List[dict]) -> dict:
+    # Candidate responses are stored as parallel arrays, so confidences can be
+    # compared with vector operations
+    return {
+        "contents": contents,
+        "confidences": np.array(confidences, dtype=np.float32),
+        "infos": infos,
+    }
+
+
+def _take_candidates(candidates: dict, indices: List[int]) -> dict:
+    return {
+        "contents": [candidates["contents"][i] for i in indices],
+        "confidences": candidates["confidences"][list(indices)],
+        "infos": [candidates["infos"][i] for i in indices],
+    }
+
+
+def _fnv1a(data: bytes) -> int:
+    # 64-bit FNV-1a, folded to 32 bits so it can be used directly as a seed
+    h = 0xcbf29ce484222325
+    for byte in data:
+        h = ((h ^ byte) * 0x100000001b3) & 0xFFFFFFFFFFFFFFFF
+    return h % 2**32
+
+
 class Pipeline:
     class Valves(BaseModel):
         pipelines: List[str] = []
@@ -25,7 +96,15 @@ class Pipeline:
         max_tokens: int = 256  # Maximum tokens to generate
         evaluation_temperature: float = 0.5  # Temperature for the evaluation step
         evaluation_max_tokens: int = 512  # Max tokens for the evaluation response
+        evaluation_candidate_max_chars: int = 800  # Truncate each candidate in the evaluation prompt (0 disables)
+        dedupe_similarity: float = 0.95  # Drop same-answer candidates more similar than this to a kept one (1 disables)
+        eval_skip_margin: float = 0.3  # Skip evaluation if the best confidence beats the runner-up by this ratio (0 disables)
         debug: bool = True  # Enable debugging output
+        keep_alive: str = ""  # How long Ollama keeps the model loaded after a request (empty uses the server's default)
+        compress_requests: bool = False  # Gzip large request bodies (the server must accept Content-Encoding: gzip)
+        cache_size: int = 1024  # Number of responses to keep for repeated prompts (0 disables)
+        batch_sampling: bool = False  # Ask for all k candidates in a single generation
+        early_stop_confidence: float = 0.0  # Stop sampling once a response exceeds this confidence (0 disables)
 
     def __init__(self):
         self.name = "CoT-Decoding Pipeline with Self-Evaluation"
@@ -40,18 +119,122 @@ class Pipeline:
                 "max_tokens": int(os.getenv("COT_DECODING_MAX_TOKENS", "256")),
                 "evaluation_temperature": float(os.getenv("EVALUATION_TEMPERATURE", "0.5")),
                 "evaluation_max_tokens": int(os.getenv("EVALUATION_MAX_TOKENS", "512")),
+                "evaluation_candidate_max_chars": int(os.getenv("EVALUATION_CANDIDATE_MAX_CHARS", "800")),
+                "dedupe_similarity": float(os.getenv("COT_DECODING_DEDUPE_SIMILARITY", "0.95")),
+                "eval_skip_margin": float(os.getenv("EVALUATION_SKIP_MARGIN", "0.3")),
                 "debug": os.getenv("COT_DECODING_DEBUG", "True") == "True",
+                "keep_alive": os.getenv("COT_DECODING_KEEP_ALIVE", ""),
+                "compress_requests": os.getenv("COT_DECODING_COMPRESS_REQUESTS", "False") == "True",
+                "cache_size": int(os.getenv("COT_DECODING_CACHE_SIZE", "1024")),
+                "batch_sampling": os.getenv("COT_DECODING_BATCH_SAMPLING", "False") == "True",
+                "early_stop_confidence": float(os.getenv("COT_DECODING_EARLY_STOP_CONFIDENCE", "0.0")),
             }
         )
+        # The k samples are requested concurrently; Ollama only serves them in
+        # parallel when OLLAMA_NUM_PARALLEL >= k on the server side.
+        pool_size = max(self.valves.k, 20)
+        # Over https (e.g. Ollama behind a reverse proxy) the k requests are
+        # multiplexed on one HTTP/2 connection; plain http stays on HTTP/1.1
+        # keep-alive connections, since httpx only negotiates HTTP/2 via TLS.
+        self.client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(120.0),
+        )
+        # Blocking calls reuse pooled keep-alive connections to Ollama.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=max(32, self.valves.k * 2),
+            max_retries=Retry(total=2, backoff_factor=0.1),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # LRU of (best_response, inner_monologue) keyed by a digest of the request
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Futures for responses currently being generated, so identical
+        # concurrent requests wait for the first one instead of sampling again
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # pipe() is called synchronously, so async work runs on a long-lived loop
+        # owned by the pipeline, which the client's connection pool is bound to.
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        self._configure_debug()
 
     async def on_startup(self):
         print(f"on_startup: {self.name}")
+        await self.warm_up_model()
 
     async def on_shutdown(self):
         print(f"on_shutdown: {self.name}")
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self.client.aclose(), self._loop))
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self.session.close()
 
     async def on_valves_updated(self):
-        pass
+        self._configure_debug()
+        # Cached answers depend on valves that are not part of the cache key
+        with self._cache_lock:
+            self._cache.clear()
+        await self.warm_up_model()
+
+    async def warm_up_model(self):
+        # Load the model now so the first pipe() call does not pay for it
+        if not self.valves.model:
+            return
+        api_url = self.valves.ollama_api_url.replace("/api/chat", "/api/generate")
+        params = {
+            "model": self.valves.model,
+            "prompt": "",
+            "options": {"num_predict": 1},
+            **self._keep_alive_fields()
+        }
+        try:
+            response = await asyncio.to_thread(
+                self.session.post, api_url, data=orjson.dumps(params), headers=JSON_HEADERS
+            )
+        except requests.RequestException as e:
+            print(f"Error warming up model {self.valves.model}: {e!r}")
+            return
+        if response.status_code != 200:
+            print(f"Error warming up model {self.valves.model}: {response.status_code} - {response.text}")
+
+    def _keep_alive_fields(self) -> dict:
+        # Only override the server's OLLAMA_KEEP_ALIVE when a value is configured
+        keep_alive = self.valves.keep_alive.strip()
+        if not keep_alive:
+            return {}
+        # Ollama only accepts a bare number of seconds (e.g. -1) as a JSON number
+        if keep_alive.lstrip("-").isdigit():
+            return {"keep_alive": int(keep_alive)}
+        return {"keep_alive": keep_alive}
+
+    def _configure_debug(self):
+        # Bind the debug printers once, so disabled debugging costs a no-op call
+        # instead of a check at every call site. _dbg takes %-style arguments and
+        # only formats them when debugging is on.
+        if self.valves.debug:
+            self._dbg = self._print_debug
+            self._dbg_messages = self._print_messages
+            self._dbg_responses = self._print_responses
+        else:
+            self._dbg = self._dbg_messages = self._dbg_responses = lambda *args, **kwargs: None
+
+    def _print_debug(self, message: str, *args):
+        print(message % args if args else message)
+
+    def _print_messages(self, title: str, messages: List[dict]):
+        print("\n".join([title] + [f"{msg['role'].capitalize()}: {msg['content']}" for msg in messages]))
+
+    def _print_responses(self, title: str, candidates: dict):
+        print("\n".join([title] + [
+            f"Response {idx} (seed {info.get('seed')}, confidence {confidence:.4f}): {content}\n"
+            for idx, (content, confidence, info) in enumerate(
+                zip(candidates["contents"], candidates["confidences"], candidates["infos"]), 1
+            )
+        ]))
 
     def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
@@ -59,49 +242,140 @@ class Pipeline:
         if not self.valves.model:
             return f"Please select a model to use with this pipeline {model_id}"
 
-        # Use messages directly
-        conversation_history = messages.copy()
+        # Use messages directly; they are only read, never mutated
+        conversation_history = messages
 
-        if self.valves.debug:
-            print("Conversation History:")
-            for msg in conversation_history:
-                print(f"{msg['role'].capitalize()}: {msg['content']}")
+        self._dbg_messages("Conversation History:", conversation_history)
 
         # Get top-k alternative responses for the last user message
         last_user_message = self.get_last_user_message(conversation_history)
         if not last_user_message:
             return "No user message found."
 
-        top_k_responses = self.get_top_k_responses(
-            self.valves.model or model_id,
-            conversation_history,
+        request_key = orjson.dumps({
+            "model": self.valves.model or model_id,
+            "messages": conversation_history,
+            "t": self.valves.temperature,
+            "k": self.valves.k,
+            "mt": self.valves.max_tokens,
+        }, option=orjson.OPT_SORT_KEYS)
+        # Key the cache on a digest so entries do not hold the whole history
+        cache_key = hashlib.blake2b(request_key, digest_size=16).digest()
+        prompt_hash = _fnv1a(cache_key)
+
+        cached = self._cache_get(cache_key)
+        if cached:
+            self._dbg("\nReturning cached response")
+            return self.format_response(*cached)
+
+        # Only one of several identical concurrent requests does the work
+        future, leader = self._inflight_start(cache_key)
+        if not leader:
+            self._dbg("\nWaiting for an identical request in progress")
+            try:
+                result = future.result(timeout=30)
+            except FutureTimeoutError:
+                result = None
+            if result:
+                return self.format_response(*result)
+            # Generate it ourselves, but leave the other request's entry alone:
+            # it is still running and its remaining waiters keep waiting on it
+            future = None
+
+        streaming = False
+        try:
+            response = self.generate_response(
+                self.valves.model or model_id, conversation_history, cache_key, prompt_hash
+            )
+            if isinstance(response, str):
+                return response
+            streaming = True
+            stream = self._stream_inflight(response, cache_key, future)
+            # A generator that is never iterated never runs its finally block,
+            # so also release the entry when the stream is garbage collected
+            weakref.finalize(stream, self._inflight_finish, cache_key, future)
+            return stream
+        finally:
+            if not streaming:
+                self._inflight_finish(cache_key, future)
+
+    def generate_response(
+        self, model: str, conversation_history: List[dict], cache_key: bytes, prompt_hash: int
+    ) -> Union[str, Generator]:
+        # Remove the assistant's last response if any. Every sampling and
+        # evaluation request starts with this exact list, so Ollama can reuse
+        # its prompt cache for the shared history instead of reprocessing it.
+        end = len(conversation_history)
+        while end > 0 and conversation_history[end - 1]['role'] == 'assistant':
+            end -= 1
+        base_messages = conversation_history[:end]
+
+        top_k_responses = self._run(self.get_top_k_responses(
+            model,
+            base_messages,
             self.valves.k,
             self.valves.temperature,
             self.valves.max_tokens,
-            self.valves.ollama_api_url
+            self.valves.ollama_api_url,
+            prompt_hash
+        ))
+
+        self._dbg_responses("\nGenerated Responses:", top_k_responses)
+
+        # Near-identical candidates only add evaluation prompt tokens
+        candidates = self.deduplicate_responses(top_k_responses)
+        if len(candidates["contents"]) < len(top_k_responses["contents"]):
+            self._dbg("Kept %d of %d responses after removing near-duplicates",
+                      len(candidates["contents"]), len(top_k_responses["contents"]))
+
+        # No need to ask the model to choose when the samples already agree
+        decided = self.select_without_evaluation(
+            candidates, len(top_k_responses["contents"]), self.valves.k
         )
+        if decided:
+            self._dbg("\nEvaluation %s", decided[1])
+            self._cache_put(cache_key, decided)
+            return self.format_response(*decided)
 
-        if self.valves.debug:
-            print("\nGenerated Responses:")
-            for idx, response in enumerate(top_k_responses):
-                print(f"Response {idx + 1}: {response['content']}\n")
+        if not self.valves.debug:
+            # Stream the final response; only the debug output needs it in full
+            return self.stream_best_response_with_model(
+                model,
+                base_messages,
+                candidates,
+                self.valves.evaluation_temperature,
+                self.valves.evaluation_max_tokens,
+                self.valves.ollama_api_url,
+                cache_key
+            )
 
         # Use the model to select or generate the best response
         best_response, inner_monologue = self.select_best_response_with_model(
-            self.valves.model or model_id,
-            conversation_history,
-            top_k_responses,
+            model,
+            base_messages,
+            candidates,
             self.valves.evaluation_temperature,
             self.valves.evaluation_max_tokens,
             self.valves.ollama_api_url
         )
 
-        if self.valves.debug:
-            print("\nInner Monologue:")
-            print(inner_monologue)
-            print("\nSelected Best Response:")
-            print(best_response)
+        if best_response is None:
+            # The evaluation call failed, fall back to the most confident sample
+            best = self.select_best_response(top_k_responses)
+            if best:
+                print("\nEvaluation failed, using the most confident response")
+                return self.format_response(best["response"], "(evaluation failed)")
+
+        print("\nInner Monologue:")
+        print(inner_monologue)
+        print("\nSelected Best Response:")
+        print(best_response)
 
+        if best_response:
+            self._cache_put(cache_key, (best_response, inner_monologue))
+        return self.format_response(best_response, inner_monologue)
+
+    def format_response(self, best_response: Optional[str], inner_monologue: Optional[str]) -> str:
         if best_response:
             if self.valves.debug:
                 # Include the inner monologue before the final response
@@ -111,76 +385,285 @@ class Pipeline:
         else:
             return "I'm sorry, but I couldn't generate a response."
 
+    def _encode_body(self, body: bytes) -> (bytes, dict):
+        if self.valves.compress_requests and len(body) > GZIP_MIN_SIZE:
+            return gzip.compress(body), GZIP_JSON_HEADERS
+        return body, JSON_HEADERS
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _cache_get(self, key: bytes) -> Optional[tuple]:
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        return None
+
+    def _cache_put(self, key: bytes, value: tuple):
+        with self._cache_lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.valves.cache_size:
+                self._cache.popitem(last=False)
+        # Hand the response to any identical requests waiting on it
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None and not future.done():
+                future.set_result(value)
+
+    def _inflight_start(self, key: bytes) -> (Future, bool):
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future, False
+            future = self._inflight[key] = Future()
+            return future, True
+
+    def _inflight_finish(self, key: bytes, future: Optional[Future]):
+        if future is None:
+            return
+        with self._inflight_lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            if not future.done():
+                # Nothing was cached, let the waiting requests generate their own
+                future.set_result(None)
+
+    def _stream_inflight(self, chunks: Generator, cache_key: bytes, future: Optional[Future]) -> Generator:
+        try:
+            yield from chunks
+        finally:
+            self._inflight_finish(cache_key, future)
+
     def get_last_user_message(self, messages: List[dict]) -> Optional[dict]:
         for msg in reversed(messages):
             if msg['role'] == 'user':
                 return msg
         return None
 
-    def get_top_k_responses(
-        self, model: str, messages: List[dict], k: int, temperature: float, max_tokens: int, api_url: str
-    ) -> List[dict]:
-        responses = []
+    async def get_top_k_responses(
+        self, model: str, messages: List[dict], k: int, temperature: float, max_tokens: int, api_url: str,
+        prompt_hash: int
+    ) -> dict:
+        if self.valves.batch_sampling:
+            responses = await self.get_batched_responses(
+                model, messages, k, temperature, max_tokens, api_url, prompt_hash
+            )
+            if len(responses["contents"]) >= k:
+                return _take_candidates(responses, range(k))
+            self._dbg("Batched sampling returned %d of %d candidates, falling back to separate requests",
+                      len(responses["contents"]), k)
+
+        async def generate(idx: int, seed: int, body: bytes):
+            content, headers = self._encode_body(body)
+            return idx, seed, await self.client.post(api_url, content=content, headers=headers)
+
+        messages_json = orjson.dumps(messages)
+        tasks = []
         for i in range(k):
-            seed = random.randint(0, int(1e6))
-            # Prepare the messages for this generation
-            messages_for_generation = messages.copy()
-            # Remove the assistant's last response if any
-            while messages_for_generation and messages_for_generation[-1]['role'] == 'assistant':
-                messages_for_generation.pop()
-
-            params = {
-                "model": model,
-                "messages": messages_for_generation,
-                "options": {
+            # Derive the seed from the prompt so identical requests are reproducible;
+            # Knuth's multiplicative step spreads the k seeds over the 32-bit range
+            seed = (prompt_hash + i * 2654435761) & 0xFFFFFFFF
+
+            body = _encode_chat_request(
+                model,
+                messages_json,
+                options={
                     "seed": seed,
-                    "temperature": temperature,
-                    "max_tokens": max_tokens
+                    # Spread the temperatures evenly over 0.8x-1.2x so the paths diverge
+                    "temperature": temperature * (0.8 + 0.4 * i / max(k - 1, 1)),
+                    # Ollama's name for the generation length limit
+                    "num_predict": max_tokens
                 },
-                "stream": False
-            }
-            response = requests.post(api_url, json=params)
-            if response.status_code == 200:
-                data = response.json()
+                stream=False,
+                **self._keep_alive_fields(),
+                # Token probabilities for the confidence score; ignored by
+                # Ollama versions without logprobs support
+                logprobs=True,
+                top_logprobs=2
+            )
+            tasks.append(asyncio.create_task(generate(i, seed, body)))
+
+        # Handle responses as they arrive, so sampling can stop early once one
+        # of them is confident enough
+        threshold = self.valves.early_stop_confidence
+        results = []
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                try:
+                    idx, seed, response = await next_result
+                except Exception as e:
+                    print(f"Error in API call: {e!r}")
+                    continue
+                if response.status_code != 200:
+                    print(f"Error in API call: {response.status_code} - {response.text}")
+                    continue
+                data = orjson.loads(response.content)
                 assistant_message = data.get("message", {})
                 response_text = assistant_message.get("content", "").strip()
-                if response_text:
-                    responses.append({
-                        "content": response_text
-                    })
-            else:
-                print(f"Error in API call: {response.status_code} - {response.text}")
-        return responses
+                if not response_text:
+                    continue
+                confidence = self.calculate_confidence(data)
+                results.append((idx, response_text, confidence, {
+                    "seed": seed,
+                    "eval_count": data.get("eval_count", 0),
+                    "eval_duration": data.get("eval_duration", 0)
+                }))
+                if threshold and confidence > threshold:
+                    self._dbg("Response confidence %.4f exceeds %s, cancelling remaining samples",
+                              confidence, threshold)
+                    results[-1][3]["early_stop"] = True
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-    def select_best_response_with_model(
-        self, model: str, messages: List[dict], responses: List[dict],
-        temperature: float, max_tokens: int, api_url: str
-    ) -> (Optional[str], Optional[str]):
-        # Prepare the evaluation messages
-        evaluation_messages = messages.copy()
-        # Remove the assistant's last response if any
-        while evaluation_messages and evaluation_messages[-1]['role'] == 'assistant':
-            evaluation_messages.pop()
+        # Keep the seed order so the evaluation prompt is reproducible
+        results.sort(key=lambda result: result[0])
+        _, contents, confidences, infos = zip(*results) if results else ((), (), (), ())
+        return _make_candidates(list(contents), list(confidences), list(infos))
+
+    def calculate_confidence(self, data: dict) -> float:
+        # Mean margin between the two most likely tokens at each step, as in
+        # the CoT-decoding paper. Decoding speed says nothing about the answer,
+        # so responses without logprobs get no confidence at all.
+        logprobs = data.get("logprobs")
+        if not logprobs:
+            return 0.0
+        # (T, V) log-probabilities, padded with -inf (probability 0) so every
+        # step has at least two alternatives
+        width = max(2, max(len(token.get("top_logprobs") or ()) for token in logprobs))
+        token_logprobs = np.full((len(logprobs), width), -np.inf, dtype=np.float32)
+        for row, token in zip(token_logprobs, logprobs):
+            top = token.get("top_logprobs") or [token]
+            row[:len(top)] = [t["logprob"] for t in top]
+        top2 = np.partition(np.exp(token_logprobs), -2, axis=-1)[:, -2:]
+        return float((top2[:, 1] - top2[:, 0]).mean())
+
+    def select_best_response(self, candidates: dict) -> Optional[dict]:
+        if not candidates["contents"]:
+            return None
+        idx = int(np.argmax(candidates["confidences"]))
+        return {
+            "response": candidates["contents"][idx],
+            "confidence": float(candidates["confidences"][idx]),
+            "info": candidates["infos"][idx]
+        }
+
+    async def get_batched_responses(
+        self, model: str, messages: List[dict], k: int, temperature: float, max_tokens: int, api_url: str,
+        seed: int
+    ) -> dict:
+        # Append the instruction after the shared history to keep the prefix intact
+        messages_for_generation = messages + [{
+            "role": "system",
+            "content": f"Produce {k} independent candidate answers, each prefixed with [i] for i from 1 to {k}."
+        }]
+
+        params = {
+            "model": model,
+            "messages": messages_for_generation,
+            "options": {
+                "seed": seed,
+                # Keep the candidates diverse even though they share one sample
+                "temperature": max(temperature, 1.0),
+                "num_predict": max_tokens * k
+            },
+            "stream": False,
+            **self._keep_alive_fields()
+        }
+        try:
+            content, headers = self._encode_body(orjson.dumps(params))
+            response = await self.client.post(api_url, content=content, headers=headers)
+        except httpx.HTTPError as e:
+            print(f"Error in batched API call: {e!r}")
+            return _make_candidates([], [], [])
+        if response.status_code != 200:
+            print(f"Error in batched API call: {response.status_code} - {response.text}")
+            return _make_candidates([], [], [])
+
+        data = orjson.loads(response.content)
+        content = data.get("message", {}).get("content", "")
+        segments = re.findall(r"\[(\d+)\]\s*(.+?)(?=\n\[\d+\]|\Z)", content, re.S)
+        contents = [text.strip() for _, text in segments if text.strip()]
+        # One generation, so there is no per-candidate confidence
+        return _make_candidates(contents, [0.0] * len(contents), [{"seed": seed} for _ in contents])
+
+    def deduplicate_responses(self, candidates: dict) -> dict:
+        threshold = self.valves.dedupe_similarity
+        contents = candidates["contents"]
+        signatures = [_answer_signature(content) for content in contents]
+        # Visit the most confident responses first so they represent their group
+        ranked = np.argsort(-candidates["confidences"], kind="stable")
+        unique = []
+        for idx in ranked:
+            # Only merge candidates with the same conclusion
+            if not any(
+                signatures[idx] == signatures[u]
+                and matcher.quick_ratio() > threshold and matcher.ratio() > threshold
+                for u, matcher in ((u, SequenceMatcher(None, contents[idx], contents[u])) for u in unique)
+            ):
+                unique.append(int(idx))
+        # Keep the original order in the evaluation prompt
+        return _take_candidates(candidates, sorted(unique))
 
+    def select_without_evaluation(self, candidates: dict, sampled: int, requested: int) -> Optional[tuple]:
+        # sampled is the number of responses before deduplication, requested is k
+        contents = candidates["contents"]
+        if len(contents) == 1:
+            if sampled > 1:
+                return contents[0], "(skipped: all candidates agreed)"
+            if candidates["infos"][0].get("early_stop"):
+                return contents[0], "(skipped: sampling stopped early at a confident response)"
+            if requested > 1:
+                return contents[0], f"(skipped: only 1 of {requested} samples succeeded)"
+            return contents[0], "(skipped: only one sample requested)"
+        margin = self.valves.eval_skip_margin
+        if not margin or len(contents) < 2:
+            return None
+        runner_up, best = np.argsort(candidates["confidences"], kind="stable")[-2:]
+        best_confidence = candidates["confidences"][best]
+        if best_confidence > 0 and best_confidence > candidates["confidences"][runner_up] * (1 + margin):
+            return contents[best], "(skipped: confidence margin)"
+        return None
+
+    def build_evaluation_messages(
+        self, messages: List[dict], candidates: dict
+    ) -> (List[dict], str):
+        max_chars = self.valves.evaluation_candidate_max_chars
         # Compile the possible responses into a string
-        possible_responses_text = "I have considered the following possible responses:\n"
-        for idx, response in enumerate(responses, 1):
-            possible_responses_text += f"[{idx}] {response['content']}\n"
-        possible_responses_text += (
+        parts = ["I have considered the following possible responses:\n"]
+        append = parts.append
+        for idx, content in enumerate(candidates["contents"], 1):
+            if max_chars and len(content) > max_chars:
+                # Cut the middle of the reasoning so the conclusion stays visible
+                head = max_chars // 3
+                tail = max_chars - head
+                content = content[:head].rstrip() + " ... " + content[-tail:].lstrip()
+            append(f"[{idx}] {content}\n")
+        append(
             "\nPlease provide the best possible response to the last user message based on the options above."
             "\nDo not mention the options or this instruction in your final answer."
         )
+        possible_responses_text = "".join(parts)
 
         # Add the possible responses and instructions as a 'user' message
-        evaluation_messages.append({
+        evaluation_messages = messages + [{
             "role": "user",
             "content": possible_responses_text
-        })
+        }]
 
-        if self.valves.debug:
-            print("\nEvaluation Messages:")
-            for msg in evaluation_messages:
-                print(f"{msg['role'].capitalize()}: {msg['content']}")
+        self._dbg_messages("\nEvaluation Messages:", evaluation_messages)
+
+        return evaluation_messages, possible_responses_text
+
+    def select_best_response_with_model(
+        self, model: str, messages: List[dict], candidates: dict,
+        temperature: float, max_tokens: int, api_url: str
+    ) -> (Optional[str], Optional[str]):
+        evaluation_messages, possible_responses_text = self.build_evaluation_messages(messages, candidates)
 
         # Call the model with the evaluation messages
         params = {
@@ -188,16 +671,65 @@ class Pipeline:
             "messages": evaluation_messages,
             "options": {
                 "temperature": temperature,
-                "max_tokens": max_tokens
+                "num_predict": max_tokens
             },
-            "stream": False
+            "stream": False,
+            **self._keep_alive_fields()
         }
-        response = requests.post(api_url, json=params)
+        data, headers = self._encode_body(orjson.dumps(params))
+        response = self.session.post(api_url, data=data, headers=headers)
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             assistant_message = data.get("message", {})
             final_response = assistant_message.get("content", "").strip()
             return final_response, possible_responses_text
         else:
             print(f"Error in evaluation API call: {response.status_code} - {response.text}")
             return None, None
+
+    def stream_best_response_with_model(
+        self, model: str, messages: List[dict], candidates: dict,
+        temperature: float, max_tokens: int, api_url: str, cache_key: bytes
+    ) -> Generator[str, None, None]:
+        evaluation_messages, possible_responses_text = self.build_evaluation_messages(messages, candidates)
+
+        # Same evaluation call, but forward the tokens as Ollama produces them
+        params = {
+            "model": model,
+            "messages": evaluation_messages,
+            "options": {
+                "temperature": temperature,
+                "num_predict": max_tokens
+            },
+            "stream": True,
+            **self._keep_alive_fields()
+        }
+        data, headers = self._encode_body(orjson.dumps(params))
+        with self.session.post(api_url, data=data, headers=headers, stream=True) as response:
+            if response.status_code != 200:
+                print(f"Error in evaluation API call: {response.status_code} - {response.text}")
+                # Fall back to the most confident sample
+                best = self.select_best_response(candidates)
+                yield best["response"] if best else self.format_response(None, None)
+                return
+
+            parts = []
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = orjson.loads(line)
+                content = chunk.get("message", {}).get("content", "")
+                if not parts:
+                    # Match the stripped output of the blocking path
+                    content = content.lstrip()
+                if content:
+                    parts.append(content)
+                    yield content
+                if chunk.get("done"):
+                    break
+
+        final_response = "".join(parts).strip()
+        if final_response:
+            self._cache_put(cache_key, (final_response, possible_responses_text))
+        else:
+            yield self.format_response(None, None)